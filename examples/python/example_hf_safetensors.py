@@ -5,9 +5,8 @@
 ##################################################
 
 # imports
-import os, sys, base64
+import os, sys, base64, struct, json, hashlib, shutil, tempfile
 from safetensors import safe_open
-from safetensors.torch import save_file
 from io import BytesIO
 from PIL import Image
 
@@ -27,8 +26,26 @@ metadata = {
     "modelspec.usage_hint": "Use keyword 'example'" # In your own language, very short hints about how the user should use the model
 }
 
+# All keys defined by the spec start with this
+modelspec_prefix = "modelspec."
+modelspec_prefix_len = len(modelspec_prefix)
+
 # set to "" to disable
 image_path = "../images/example.jpg"
+# Max width/height of the thumbnail, larger images are scaled down to fit
+thumbnail_size = 512
+# Image info a small jpeg may carry and still be embedded as-is. Anything else (EXIF camera/GPS data, ICC profiles, XMP, ...) means re-encoding
+plain_jpeg_info = {"jfif", "jfif_version", "jfif_unit", "jfif_density", "dpi", "progressive", "progression"}
+
+# Headers of large models list thousands of tensors, so use the much faster 'orjson' if it is installed
+try:
+    import orjson
+    json_loads, json_dumps = orjson.loads, orjson.dumps
+except ImportError:
+    json_loads, json_dumps = json.loads, lambda obj: json.dumps(obj).encode('utf-8')
+
+# Size of the blocks used to copy tensor content when it has to go through python, so large models never need to fit in RAM
+chunk_size = 4 * 1024 * 1024
 
 # Inputs
 if len(sys.argv) < 3:
@@ -38,49 +55,123 @@ if len(sys.argv) < 3:
 file_name_in = sys.argv[1]
 file_name_out = sys.argv[2]
 
-if file_name_in == file_name_out:
-    print("Input and output files must be different, HF safetensors retains a lock on the original file")
+if os.path.exists(file_name_out) and os.path.samefile(file_name_in, file_name_out):
+    print("Input and output files must be different, the tensor content is copied from the original file while saving")
     sys.exit(1)
 
 # Actual processing
 def process():
     if image_path != "":
         print("Loading image...")
-        img = Image.open(image_path)
-        image_ext = os.path.splitext(image_path)[1]
             # ===== Update the thumbnail for modelspec from an image =====
-        metadata["modelspec.thumbnail"] = f"data:image/jpeg;base64,{convert_to_b64(img)}"
+        metadata["modelspec.thumbnail"] = load_thumbnail(image_path)
 
-    tensors = {}
     orig_metadata = None
     print("Loading...")
-        # ===== Load the safetensors data via torch and HF code, and copy the metadata =====
-    with safe_open(file_name_in, framework="pt", device="cpu") as f:
-        orig_metadata = f.metadata()
-        for key in f.keys():
-            tensors[key] = f.get_tensor(key)
+        # ===== Load the metadata via HF code. The tensors themselves are never loaded, as only the header changes =====
+    with safe_open(file_name_in, framework="np") as f: # numpy is enough to read metadata, torch is not needed
+        orig_metadata = f.metadata() or {}
     # TODO: Hash the tensor data, same as in 'example_no_reqs.py'.
 
     # ===== Simple reading of existing ModelSpec metadata. You can read this without reading the actual file tensors. =====
     print("Reading existing keys...")
-    for key,val in list(orig_metadata.items()):
-        if key.startswith("modelspec."):
-            print(f'    "{key}": "{val[:200] + "..." if len(val) > 200 else val}"')
-            # ===== Delete prior modelspec data for replacement. Alternately just wipe metadata head entirely. =====
-            del orig_metadata[key]
+    other_metadata = {}
+    for key,val in orig_metadata.items():
+        if key[:modelspec_prefix_len] != modelspec_prefix:
+            other_metadata[key] = val
+        elif key == "modelspec.thumbnail": # Usually a large block of base64 data, not worth printing
+            print(f'    "{key}": <{len(val)} characters of image data>')
+        else:
+            print(f'    "{key}": "{val if len(val) <= 200 else f"{val[:200]}..."}"')
+    # ===== Drop prior modelspec data for replacement. Alternately just wipe metadata head entirely. =====
+    orig_metadata = other_metadata
 
     # ===== Apply our new metadata =====
     orig_metadata.update(metadata)
 
     print("Saving...")
-    # ===== The actual save operation here entirely comes down to just specifying 'metadata=' in the standard save_file function =====
-    save_file(tensors, file_name_out, metadata=orig_metadata)
+    # ===== Only the metadata changed, so rather than re-serializing every tensor with 'save_file', swap the header and copy the tensor bytes as-is =====
+    with open(file_name_in, mode='rb') as src, open(file_name_out, mode='wb') as file_data:
+        head_len = struct.unpack('<Q', src.read(8))[0] # little-endian int64 header length prefix
+        header = json_loads(src.read(head_len)) # header itself, json string
+        payload_off = 8 + head_len # All other content is tightly packed tensors, starting right after the header
+        payload_len = os.fstat(src.fileno()).st_size - payload_off
+        header["__metadata__"] = orig_metadata
+        header = json_dumps(header) # utf-8 bytes
+        file_data.write(struct.pack('<Q', len(header)))
+        file_data.write(header)
+        file_data.flush()
+        copy_payload(src, file_data, payload_off, payload_len)
 
 # Util Functions
-def convert_to_b64(image: Image) -> str:
+def copy_payload(src, dst, offset: int, size: int):
+    # sendfile copies inside the kernel, so the content never passes through python memory
+    if hasattr(os, "sendfile"):
+        try:
+            while size > 0:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset, size)
+                if sent == 0:
+                    break
+                offset += sent
+                size -= sent
+        except OSError:
+            pass # Not supported for these files (eg some platforms or filesystems), fall back to a streamed copy
+        else:
+            if size > 0:
+                raise EOFError(f"Input file ended {size} bytes early while copying tensor content")
+            return
+    src.seek(offset)
+    shutil.copyfileobj(src, dst, length=chunk_size)
+    if src.tell() - offset < size:
+        raise EOFError(f"Input file ended {size - (src.tell() - offset)} bytes early while copying tensor content")
+
+def load_thumbnail(path: str) -> str:
+    # Encoding the image is the same work every run, so cache the result keyed by the image's path, modified time and size
+    stat = os.stat(path)
+    key = hashlib.sha1(f"v2|{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{thumbnail_size}".encode("utf-8")).hexdigest()
+    cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "modelspec")
+    cache_path = os.path.join(cache_dir, f"thumb_{key}.b64")
+    try:
+        with open(cache_path, mode='r') as cache_file:
+            cached = cache_file.read()
+        mime, _, data = cached.partition(";base64,")
+        if mime in ("data:image/jpeg", "data:image/png") and data and base64.b64decode(data, validate=True):
+            return cached
+    except (OSError, ValueError):
+        pass # Missing or broken cache entry, just encode the image again
+    img = Image.open(path)
+    if img.format == "JPEG" and max(img.size) <= thumbnail_size and img.mode in ("RGB", "L") and set(img.info) <= plain_jpeg_info:
+        # Already a small, plain jpeg, so just use the file as-is instead of decoding and re-encoding it
+        with open(path, mode='rb') as image_file:
+            thumbnail = f"data:image/jpeg;base64,{base64.b64encode(image_file.read()).decode('ascii')}"
+    else:
+        # Keep the header small: scale down to thumbnail size, and use jpeg unless transparency needs png.
+        # thumbnail() already uses jpeg draft mode, so large jpegs are decoded at a reduced scale rather than full resolution
+        img.thumbnail((thumbnail_size, thumbnail_size), Image.Resampling.LANCZOS)
+        fmt = "PNG" if img.mode in ("RGBA", "LA", "P") else "JPEG"
+        if fmt == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        thumbnail = f"data:image/{fmt.lower()};base64,{convert_to_b64(img, fmt)}"
+    cache_file = None
+    try:
+        # Write to a temporary file then move it into place, so an interrupted or concurrent run never leaves a partial entry
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        with tempfile.NamedTemporaryFile(mode='w', dir=cache_dir, suffix=".tmp", delete=False) as cache_file:
+            cache_file.write(thumbnail)
+        os.replace(cache_file.name, cache_path)
+    except OSError:
+        # The cache is only a speedup, encoding still worked. Just don't leave the temporary file behind
+        if cache_file is not None:
+            try:
+                os.remove(cache_file.name)
+            except OSError:
+                pass
+    return thumbnail
+
+def convert_to_b64(image: Image, fmt: str) -> str:
     buffered = BytesIO()
-    image.save(buffered, format="JPEG")
-    img_b64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    image.save(buffered, format=fmt, quality=85, optimize=True)
+    img_b64 = base64.b64encode(buffered.getbuffer()).decode("ascii") # getbuffer() avoids copying the encoded image
     return img_b64
 
 # Go
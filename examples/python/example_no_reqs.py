@@ -6,7 +6,8 @@
 ##################################################
 
 # Imports
-import os, sys, base64, struct, json, hashlib
+import os, sys, base64, struct, json, hashlib, shutil, mmap, tempfile, binascii
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from PIL import Image
 
@@ -26,38 +27,116 @@ metadata = {
     "modelspec.usage_hint": "Use keyword 'example'" # In your own language, very short hints about how the user should use the model
 }
 
+# All keys defined by the spec start with this
+modelspec_prefix = "modelspec."
+modelspec_prefix_len = len(modelspec_prefix)
+
 # set to "" to disable
 image_path = "../images/example.jpg"
+# Max width/height of the thumbnail, larger images are scaled down to fit
+thumbnail_size = 512
+# Image info a small jpeg may carry and still be embedded as-is. Anything else (EXIF camera/GPS data, ICC profiles, XMP, ...) means re-encoding
+plain_jpeg_info = {"jfif", "jfif_version", "jfif_unit", "jfif_density", "dpi", "progressive", "progression"}
+
+# Hash algorithm for the tensor content, written as "modelspec.hash_<algo>". The spec encourages "sha256".
+# "blake3" is several times faster, if the optional 'blake3' package is installed.
+hash_algo = "sha256"
+
+# Available hash algorithms. hashlib's sha256 is backed by OpenSSL, which already uses the CPU's SHA extensions where present.
+hash_algos = {"sha256": hashlib.sha256}
+try:
+    from blake3 import blake3
+    hash_algos["blake3"] = blake3
+except ImportError:
+    pass
+
+# Upper bound on the shard count for --parallel-hash, as the count can come from the file's own metadata.
+# The sharded hash is not defined by the spec, so it is written under a non-spec "example." prefix rather than "modelspec."
+max_shards = 256
+
+# Headers of large models list thousands of tensors, so use the much faster 'orjson' if it is installed
+try:
+    import orjson
+    json_loads, json_dumps = orjson.loads, orjson.dumps
+except ImportError:
+    json_loads, json_dumps = json.loads, lambda obj: json.dumps(obj).encode('utf-8')
+
+# Size of the blocks used to hash tensor content, and to copy it when it has to go through python
+chunk_size = 4 * 1024 * 1024
 
 # Inputs
-if len(sys.argv) < 3:
-    print("Usage: python example_no_reqs.py <in_file> <out_file>")
+args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+flags = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+unknown_flags = [flag for flag in flags if flag not in ("--rehash", "--verify", "--parallel-hash")]
+if unknown_flags:
+    print(f"Unknown option(s): {' '.join(unknown_flags)}")
+if len(args) < 2 or unknown_flags:
+    print("Usage: python example_no_reqs.py <in_file> <out_file> [--rehash] [--verify] [--parallel-hash]")
+    print("    --rehash: recompute the hash even if the file already has one (by default it is reused, as the content is copied unchanged)")
+    print("    --verify: recompute the hash, and do not save unless it matches the existing one (so the file must have one)")
+    print("    --parallel-hash: hash equal shards of the content on all CPU cores. This is NOT the plain hash of the content, so it is")
+    print("                     written as 'example.sharded_<algo>' with the shard count in 'example.shard_count'. Any existing")
+    print("                     'modelspec.hash_<algo>' is kept as well")
     sys.exit(1)
 
-file_name_in = sys.argv[1]
-file_name_out = sys.argv[2]
+file_name_in = args[0]
+file_name_out = args[1]
+
+if os.path.exists(file_name_out) and os.path.samefile(file_name_in, file_name_out):
+    print("Input and output files must be different, the tensor content is copied from the original file while saving")
+    sys.exit(1)
+rehash = "--rehash" in flags
+verify = "--verify" in flags
+parallel_hash = "--parallel-hash" in flags
 
 # Actual processing
 def process():
     if image_path != "":
         print("Loading image...")
-        img = Image.open(image_path)
-        image_ext = os.path.splitext(image_path)[1]
             # ===== Update the thumbnail for modelspec from an image =====
-        metadata["modelspec.thumbnail"] = f"data:image/jpeg;base64,{convert_to_b64(img)}"
+        metadata["modelspec.thumbnail"] = load_thumbnail(image_path)
 
     print("Loading model...")
     header = None
-    content = None
         # ===== Safetensors files are very easy to load by hand =====
-    with open(file_name_in, mode='rb') as file_data:
-        file_hash = hashlib.sha256()
-        head_len = struct.unpack('Q', file_data.read(8)) # int64 header length prefix
-        header = json.loads(file_data.read(head_len[0])) # header itself, json string
-        content = file_data.read() # All other content is tightly packed tensors. Copy to RAM for simplicity, but you can avoid this read with a more careful FS-dependent impl.
-        file_hash.update(content)
+        # Map the file rather than reading it, so the content is hashed straight out of the OS page cache
+    with open(file_name_in, mode='rb') as file_data, mmap.mmap(file_data.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        head_len = struct.unpack_from('<Q', mapped, 0)[0] # little-endian int64 header length prefix
+        header = json_loads(mapped[8:8 + head_len]) # header itself, json string
+        payload_off = 8 + head_len # All other content is tightly packed tensors, starting right after the header
+        payload_len = len(mapped) - payload_off
         # ===== Update the hash for modelspec =====
-        metadata["modelspec.hash_sha256"] = f"0x{file_hash.hexdigest()}"
+        existing = header.get("__metadata__", {})
+        plain_hash_key = f"modelspec.hash_{hash_algo}"
+        hash_key = f"example.sharded_{hash_algo}" if parallel_hash else plain_hash_key
+        hashed = rehash or verify or hash_key not in existing
+        if verify and hash_key not in existing:
+            print(f"Cannot verify, the file has no existing '{hash_key}' to compare against. Not saving")
+            sys.exit(1)
+        if hashed and hasattr(mmap, "MADV_SEQUENTIAL"):
+            # Read-ahead hints for the content about to be hashed, where the platform supports them. madvise needs a page-aligned start
+            advise_off = payload_off - payload_off % mmap.PAGESIZE
+            mapped.madvise(mmap.MADV_SEQUENTIAL, advise_off, len(mapped) - advise_off)
+            mapped.madvise(mmap.MADV_WILLNEED, advise_off, len(mapped) - advise_off)
+        if parallel_hash and plain_hash_key in existing:
+            # The sharded hash is not a replacement for the spec's plain hash, so keep that too
+            metadata[plain_hash_key] = existing[plain_hash_key]
+        if not hashed:
+            # The content is copied unchanged, so the existing hash is still correct and the expensive hashing can be skipped
+            print("Reusing existing hash (use --rehash to recompute it)")
+            metadata[hash_key] = existing[hash_key]
+            if parallel_hash and "example.shard_count" in existing:
+                metadata["example.shard_count"] = existing["example.shard_count"]
+        elif parallel_hash:
+            # Reuse the original shard count when there is a valid one, so the hash can be compared on any machine
+            count = existing.get("example.shard_count", "")
+            nshards = int(count) if isinstance(count, str) and count.isdecimal() and 1 <= int(count) <= max_shards else min(os.cpu_count() or 1, max_shards)
+            metadata["example.shard_count"] = str(nshards)
+            metadata[hash_key] = format_hash(hash_payload_parallel(mapped, payload_off, payload_len, nshards))
+        else:
+            with memoryview(mapped) as view:
+                file_hash = hash_chunks(view[payload_off:])
+            metadata[hash_key] = format_hash(file_hash.digest())
 
     # ===== Simple reading of existing ModelSpec metadata. You can read this without reading the actual file content. =====
     if "__metadata__" not in header:
@@ -67,19 +146,27 @@ def process():
         orig_metadata = header["__metadata__"]
         
         # ===== Check hash =====
-        if "modelspec.hash_sha256" in orig_metadata:
-            hash = orig_metadata["modelspec.hash_sha256"]
-            actual_hash = metadata["modelspec.hash_sha256"]
+        if hashed and hash_key in orig_metadata:
+            hash = orig_metadata[hash_key]
+            actual_hash = metadata[hash_key]
             matches = hash == actual_hash
             result = "MATCH" if matches else f"FAIL, DID NOT MATCH {hash} != {actual_hash}"
             print(f"Comparing original hash to computed hash: {result}")
+            if verify and not matches:
+                print("Not saving, the file content does not match its hash")
+                sys.exit(1)
 
         print("File has metadata! Content:")
-        for key,val in list(orig_metadata.items()):
-            if key.startswith("modelspec."):
-                print(f'    "{key}": "{val[:200] + "..." if len(val) > 200 else val}"')
-                # ===== Delete prior modelspec data for replacement. Alternately just wipe metadata head entirely. =====
-                del orig_metadata[key]
+        other_metadata = {}
+        for key,val in orig_metadata.items():
+            if key[:modelspec_prefix_len] != modelspec_prefix:
+                other_metadata[key] = val
+            elif key == "modelspec.thumbnail": # Usually a large block of base64 data, not worth printing
+                print(f'    "{key}": <{len(val)} characters of image data>')
+            else:
+                print(f'    "{key}": "{val if len(val) <= 200 else f"{val[:200]}..."}"')
+        # ===== Drop prior modelspec data for replacement. Alternately just wipe metadata head entirely. =====
+        orig_metadata = other_metadata
     
     # ===== Apply our new metadata =====
     orig_metadata.update(metadata)
@@ -88,17 +175,103 @@ def process():
     print("Loaded! Saving...")
     with open(file_name_out, mode='wb') as file_data:
         # ===== Write the header =====
-        header = json.dumps(header)
-        file_data.write(struct.pack('Q', len(header)))
-        file_data.write(header.encode('utf-8'))
-        # ===== Write the content =====
-        file_data.write(content)
+        header = json_dumps(header) # utf-8 bytes
+        file_data.write(struct.pack('<Q', len(header)))
+        file_data.write(header)
+        # ===== Write the content, copied straight from the input file =====
+        file_data.flush()
+        with open(file_name_in, mode='rb') as src:
+            copy_payload(src, file_data, payload_off, payload_len)
 
 # Util Functions
-def convert_to_b64(image: Image) -> str:
+def copy_payload(src, dst, offset: int, size: int):
+    # sendfile copies inside the kernel, so the content never passes through python memory
+    if hasattr(os, "sendfile"):
+        try:
+            while size > 0:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset, size)
+                if sent == 0:
+                    break
+                offset += sent
+                size -= sent
+        except OSError:
+            pass # Not supported for these files (eg some platforms or filesystems), fall back to a streamed copy
+        else:
+            if size > 0:
+                raise EOFError(f"Input file ended {size} bytes early while copying tensor content")
+            return
+    src.seek(offset)
+    shutil.copyfileobj(src, dst, length=chunk_size)
+    if src.tell() - offset < size:
+        raise EOFError(f"Input file ended {size - (src.tell() - offset)} bytes early while copying tensor content")
+
+def hash_payload_parallel(mapped: mmap.mmap, offset: int, size: int, nshards: int) -> bytes:
+    # Split the content into equal shards, hash each on its own thread, then hash the list of shard digests
+    bounds = [offset + size * i // nshards for i in range(nshards + 1)]
+    combined = hash_algos[hash_algo]()
+    with memoryview(mapped) as view, ThreadPoolExecutor(max_workers=min(nshards, os.cpu_count() or 1)) as pool:
+        for file_hash in pool.map(lambda start, end: hash_chunks(view[start:end]), bounds[:-1], bounds[1:]):
+            combined.update(file_hash.digest())
+    return combined.digest()
+
+def hash_chunks(view: memoryview):
+    # Feed the hash cache-sized chunks of the mapped file. hashlib releases the GIL while hashing large buffers, so threads hash in parallel
+    file_hash = hash_algos[hash_algo]()
+    for offset in range(0, len(view), chunk_size):
+        file_hash.update(view[offset:offset + chunk_size])
+    return file_hash
+
+def format_hash(digest: bytes) -> str:
+    # Spec format: "0x" prefix, all lowercase hex, no separators
+    return "0x" + binascii.b2a_hex(digest).decode("ascii")
+
+def load_thumbnail(path: str) -> str:
+    # Encoding the image is the same work every run, so cache the result keyed by the image's path, modified time and size
+    stat = os.stat(path)
+    key = hashlib.sha1(f"v2|{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{thumbnail_size}".encode("utf-8")).hexdigest()
+    cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "modelspec")
+    cache_path = os.path.join(cache_dir, f"thumb_{key}.b64")
+    try:
+        with open(cache_path, mode='r') as cache_file:
+            cached = cache_file.read()
+        mime, _, data = cached.partition(";base64,")
+        if mime in ("data:image/jpeg", "data:image/png") and data and base64.b64decode(data, validate=True):
+            return cached
+    except (OSError, ValueError):
+        pass # Missing or broken cache entry, just encode the image again
+    img = Image.open(path)
+    if img.format == "JPEG" and max(img.size) <= thumbnail_size and img.mode in ("RGB", "L") and set(img.info) <= plain_jpeg_info:
+        # Already a small, plain jpeg, so just use the file as-is instead of decoding and re-encoding it
+        with open(path, mode='rb') as image_file:
+            thumbnail = f"data:image/jpeg;base64,{base64.b64encode(image_file.read()).decode('ascii')}"
+    else:
+        # Keep the header small: scale down to thumbnail size, and use jpeg unless transparency needs png.
+        # thumbnail() already uses jpeg draft mode, so large jpegs are decoded at a reduced scale rather than full resolution
+        img.thumbnail((thumbnail_size, thumbnail_size), Image.Resampling.LANCZOS)
+        fmt = "PNG" if img.mode in ("RGBA", "LA", "P") else "JPEG"
+        if fmt == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        thumbnail = f"data:image/{fmt.lower()};base64,{convert_to_b64(img, fmt)}"
+    cache_file = None
+    try:
+        # Write to a temporary file then move it into place, so an interrupted or concurrent run never leaves a partial entry
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        with tempfile.NamedTemporaryFile(mode='w', dir=cache_dir, suffix=".tmp", delete=False) as cache_file:
+            cache_file.write(thumbnail)
+        os.replace(cache_file.name, cache_path)
+    except OSError:
+        # The cache is only a speedup, encoding still worked. Just don't leave the temporary file behind
+        if cache_file is not None:
+            try:
+                os.remove(cache_file.name)
+            except OSError:
+                pass
+    return thumbnail
+
+def convert_to_b64(image: Image, fmt: str) -> str:
     buffered = BytesIO()
-    image.save(buffered, format="JPEG")
-    img_b64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    image.save(buffered, format=fmt, quality=85, optimize=True)
+    img_b64 = base64.b64encode(buffered.getbuffer()).decode("ascii") # getbuffer() avoids copying the encoded image
     return img_b64
 
 # Go